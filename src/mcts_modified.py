@@ -1,12 +1,25 @@
-from mcts_node import MCTSNode
+from mcts_node import MCTSNode, Action, State
 from p2_t3 import Board
 from math import sqrt, log
 
 num_nodes = 1000
 explore_faction = 2.
-
-
-def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
+num_rollouts = 1  # The heuristic rollout is deterministic, so repeating it from the same node adds nothing
+batch_size = 8
+SQRT2 = 1.4142135623730951
+
+# Heuristic points for the square played inside a sub-board, indexed by row * 3 + column.
+# We like center squares the most, then the corners, and the side centers the least
+POS_SCORE_PLAY = [500, 100, 500,
+                  100, 100000000, 100,
+                  500, 100, 500]
+POS_SCORE_BLOCK = [-500, -100, -500,
+                   -100, -1000, -100,
+                   -500, -100, -500]
+
+
+def traverse_nodes(node: MCTSNode, board: Board, state: State,
+                   bot_identity: int) -> tuple[MCTSNode, State, list[MCTSNode]]:
     """ Traverses the tree until the end criterion are met.
     e.g. find the best expandable node (node with untried action) if it exist,
     or else a terminal node
@@ -20,27 +33,28 @@ def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
     Returns:
         node: A node from which the next stage of the search can proceed.
         state: The state associated with that node
+        path: The nodes walked through, from the given node down to the returned one
 
     """
-    while node.untried_actions == [] and node.child_nodes != {}:
-        currentBestUcb = -9999
-        bestChild = None
+    path = [node]
 
-        for action, child in node.child_nodes.items():
-            ucbValue = ucb(child, bot_identity == board.current_player(state))
+    while not node.untried_actions and node.child_nodes:
+        # Both of these are the same for every child, so only work them out once per level
+        is_opponent = bot_identity != board.current_player(state)
+        log_parent_visits = log(node.visits + node.virtual_loss)
 
-            if ucbValue > currentBestUcb:
-                currentBestUcb = ucbValue
-                bestChild = child
+        _, bestChild = best_child(node.child_nodes, log_parent_visits, is_opponent)
 
-        if bestChild is not None:
-            node = bestChild
-            state = board.next_state(state, bestChild.parent_action)
+        node = bestChild
+        # expand_leaf always stores the state, so every node below the root has one
+        assert bestChild.state is not None
+        state = bestChild.state
+        path.append(node)
 
-    return node, state
+    return node, state, path
 
 
-def expand_leaf(node: MCTSNode, board: Board, state):
+def expand_leaf(node: MCTSNode, board: Board, state: State) -> tuple[MCTSNode, State]:
     """ Adds a new leaf to the tree by creating a new child node for the given node (if it is non-terminal).
 
     Args:
@@ -49,27 +63,31 @@ def expand_leaf(node: MCTSNode, board: Board, state):
         state:  The state of the game.
 
     Returns:
-        node: The added child node
+        node: The added child node (or the given node, if it had nothing left to expand)
         state: The state associated with that node
 
     """
     if not node.untried_actions:
-        return None, state
+        return node, state
 
     actionToExpand = node.untried_actions.pop()
     newGameState = board.next_state(state, actionToExpand)
-    newChildNode = MCTSNode(parent=node, parent_action=actionToExpand, action_list=board.legal_actions(newGameState))
-    node.child_nodes[actionToExpand] = newChildNode
+    legalActions = board.legal_actions(newGameState)
+    newChildNode = MCTSNode(parent=node, parent_action=actionToExpand, action_list=list(legalActions),
+                            state=newGameState)
+    newChildNode.legal_actions = legalActions  # Saves the rollout from this node working them out again
+    node.child_nodes.append((actionToExpand, newChildNode))
 
     return newChildNode, newGameState
 
 
-def rollout(board: Board, state):
+def rollout(board: Board, state: State, legal_actions: list[Action] | None = None) -> State:
     """ Simulates possible game outcomes from the given state and returns the best final state it found
 
         Args:
             board:  The game setup.
             state:  The state of the game.
+            legal_actions:  The legal actions in the given state, if they're already known.
 
         Returns:
             state: The best terminal game state
@@ -78,24 +96,33 @@ def rollout(board: Board, state):
     current_player = board.current_player(state)
     opponent = 1 if current_player == 2 else 2
 
-    while not board.is_ended(state):
-        legal_actions = board.legal_actions(state)
+    # Bind the hot functions to locals once, since the inner loop runs for every move of every simulated game
+    is_ended = board.is_ended
+    get_legal_actions = board.legal_actions
+    next_state = board.next_state
+    score_move = heuristic
+
+    while not is_ended(state):
+        if legal_actions is None:
+            legal_actions = get_legal_actions(state)
         best_score = -9999999999999999999999
-        best_action = None
+        best_state = state
 
+        # Keep the state of the best move around so we don't have to play it again afterwards
         for action in legal_actions:
-            new_state = board.next_state(state, action)
-            score = heuristic(board, new_state, opponent, current_player, action)
+            new_state = next_state(state, action)
+            score = score_move(board, new_state, opponent, current_player, action)
             if score > best_score:
                 best_score = score
-                best_action = action
+                best_state = new_state
 
-        state = board.next_state(state, best_action)
+        state = best_state
+        legal_actions = None
 
     return state
 
 
-def heuristic(board: Board, state, opponent: int, currentPlayer: int, action):
+def heuristic(board: Board, state: State, opponent: int, currentPlayer: int, action: Action) -> int:
     """ Evaluates the given state and returns a score for the bot
 
     Args:
@@ -109,47 +136,27 @@ def heuristic(board: Board, state, opponent: int, currentPlayer: int, action):
         score: The score of the state for the bot
 
     """
-    pointGreatness = 0
+    square = action[2] * 3 + action[3]
 
     # Points if we are playing
     if currentPlayer is not opponent:
+        pointGreatness = POS_SCORE_PLAY[square]
+
         # Win, duh
         if board.win_values(state) is not None:
             pointGreatness += 100000000000
-
-        # We like center squares
-        if action[2:] == (1, 1):
-            pointGreatness += 100000000
-
-        #And the corners
-        if action[2:] in [(0, 0), (0, 2), (2, 0), (2, 2)]:
-            pointGreatness += 500
-
-        # Finally avoid the side centers
-        if action[2:] in [(1, 0), (0, 1), (1, 2), (2, 1)]:
-            pointGreatness += 100
     else:
         # Points if we are not playing
+        pointGreatness = POS_SCORE_BLOCK[square]
+
         # Win, duh
         if board.win_values(state):
             pointGreatness -= 10000
 
-        # We like center squares
-        if action[2:] == (1, 1):
-            pointGreatness -= 1000
-
-        # And the corners
-        if action[2:] in [(0, 0), (0, 2), (2, 0), (2, 2)]:
-            pointGreatness -= 500
-
-        # Finally avoid the side centers
-        if action[2:] in [(1, 0), (0, 1), (1, 2), (2, 1)]:
-            pointGreatness -= 100
-
     return pointGreatness
 
 
-def winning_move(board, state, player):
+def winning_move(board: Board, state: State, player: int) -> bool:
     for action in board.legal_actions(state):
         next_state = board.next_state(state, action)
         points_values = board.points_values(next_state)
@@ -158,100 +165,155 @@ def winning_move(board, state, player):
     return False
 
 
-def backpropagate(node: MCTSNode | None, won: bool):
-    """ Navigates the tree from a leaf node to the root, updating the win and visit count of each node along the path.
+def backpropagate(path: list[MCTSNode], wins: int, visits: int) -> None:
+    """ Updates the win and visit count of each node along the path from the root to a leaf.
 
     Args:
-        node:   A leaf node.
-        won:    An indicator of whether the bot won or lost the game.
+        path:   The nodes from the root down to the leaf.
+        wins:   How many of the simulated games the bot won.
+        visits: How many games were simulated. Their virtual loss is taken back in the same pass.
 
     """
-    while node is not None:
-        node.visits += 1
-        if won:
-            node.wins += 1
-        node = node.parent
+    for node in path:
+        node.visits += visits
+        node.wins += wins
+        node.virtual_loss -= visits
 
 
-def ucb(node: MCTSNode, is_opponent: bool):
-    """ Calcualtes the UCB value for the given node from the perspective of the bot
+def add_virtual_loss(path: list[MCTSNode], amount: int) -> None:
+    """ Adds virtual loss on every node along the path from the root to a leaf. backpropagate() takes it back off again.
 
     Args:
-        node:   A node.
-        is_opponent: A boolean indicating whether or not the last action was performed by the MCTS bot
-    Returns:
-        The value of the UCB function for the given node
-    """
-    explorationFactor = sqrt(2)
-    winRate = node.wins / node.visits
+        path:   The nodes from the root down to the leaf.
+        amount: The number of games being played out from the leaf.
 
-    if is_opponent:
-        winRate = 1 - winRate
+    """
+    for node in path:
+        node.virtual_loss += amount
 
-    return winRate + (explorationFactor * sqrt(log(node.parent.visits) / node.visits))
 
+def best_child(children: list[tuple[Action, MCTSNode]], log_parent_visits: float,
+               is_opponent: bool) -> tuple[Action, MCTSNode]:
+    """ Picks the (action, child) pair with the highest UCB value out of a fully expanded node's children
 
-def get_best_action(root_node: MCTSNode):
+    Args:
+        children: The (action, child) pairs to pick from. Must not be empty.
+        log_parent_visits: The natural log of the parent node's visit count
+        is_opponent: A boolean indicating whether or not the last action was performed by the MCTS bot
+    Returns:
+        The (action, child) pair with the best UCB value
+    """
+    bestItem = children[0]
+    bestUcb = -1.0
+    _sqrt = sqrt
+    explorationFactor = SQRT2
+
+    for item in children:
+        child = item[1]
+        # Games still being played through the child count as losses for whoever is picking, so that the other
+        # leaves in a batch get spread over different paths
+        visits = child.visits + child.virtual_loss
+        if is_opponent:
+            winRate = 1 - (child.wins + child.virtual_loss) / visits
+        else:
+            winRate = child.wins / visits
+        ucbValue = winRate + explorationFactor * _sqrt(log_parent_visits / visits)
+
+        if ucbValue > bestUcb:
+            bestUcb = ucbValue
+            bestItem = item
+
+    return bestItem
+
+
+def get_best_action(totals: dict[Action, tuple[int, int]]) -> Action | None:
     """ Selects the best action from the root node in the MCTS tree
 
     Args:
-        root_node:   The root node
+        totals:   The (wins, visits) of every root action
     Returns:
         action: The best action from the root node
     
     """
-    bestAction = None
-    bestWinRate = -9999
-
-    for action, child in root_node.child_nodes.items():
-        winRate = child.wins / child.visits
-        if winRate > bestWinRate:
-            bestWinRate = winRate
-            bestAction = action
+    if not totals:
+        return None
 
-    return bestAction
+    return max(totals, key=lambda action: totals[action][0] / totals[action][1])
 
 
-def is_win(board: Board, state, identity_of_bot: int):
+def is_win(board: Board, state: State, identity_of_bot: int) -> bool:
     # checks if state is a win state for identity_of_bot
     outcome = board.points_values(state)
     assert outcome is not None, "is_win was called on a non-terminal state"
     return outcome[identity_of_bot] == 1
 
 
-def think(board: Board, current_state):
-    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+def search_tree(board: Board, current_state: State, bot_identity: int,
+                iterations: int) -> dict[Action, tuple[int, int]]:
+    """ Builds a fresh MCTS tree from the current state and reports what it found about each move from the root.
 
     Args:
         board:  The game setup.
         current_state:  The current state of the game.
+        bot_identity:   The bot's identity, either 1 or 2
+        iterations: The number of MCTS iterations to run on this tree.
 
-    Returns:    The action to be taken from the current state
+    Returns:    An action -> (wins, visits) dictionary for the children of the root node
 
     """
-    bot_identity = board.current_player(current_state)  # 1 or 2
-    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state),
+                         state=current_state)
+
+    for batchStart in range(0, iterations, batch_size):
+        leaves: list[tuple[MCTSNode, State, list[MCTSNode]]] = []
+
+        for _ in range(min(batch_size, iterations - batchStart)):
+            # Do MCTS - This is all you!
+            # ...
+            node, state, path = traverse_nodes(root_node, board, current_state, bot_identity)
+
+            if node.untried_actions:
+                node, state = expand_leaf(node, board, state)
+                path.append(node)
+
+            # Pending games count as virtual losses until their results come in
+            add_virtual_loss(path, num_rollouts)
+            leaves.append((node, state, path))
+
+        for node, state, path in leaves:
+            wins = 0
+            for _ in range(num_rollouts):
+                rolloutState = rollout(board, state, node.legal_actions)
+                if is_win(board, rolloutState, bot_identity):
+                    wins += 1
+
+            backpropagate(path, wins, num_rollouts)
+
+    return {action: (child.wins, child.visits) for action, child in root_node.child_nodes}
 
-    for _ in range(num_nodes):
-        state = current_state
-        node = root_node
 
-        # Do MCTS - This is all you!
-        # ...
-        while not node.untried_actions and node.child_nodes:
-            node, state = traverse_nodes(node, board, state, bot_identity)
+def think(board: Board, current_state: State) -> Action | None:
+    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+
+    num_nodes is the number of tree iterations per move, and each one plays num_rollouts games from its leaf.
+
+    Unlike mcts_vanilla this searches a single tree in this process. The heuristic rollouts are deterministic, so
+    trees grown side by side in other processes come out nearly identical and only cost more CPU for the same search.
+
+    Args:
+        board:  The game setup.
+        current_state:  The current state of the game.
 
-        if node.untried_actions:
-            node, state = expand_leaf(node, board, state)
+    Returns:    The action to be taken from the current state
 
-        rolloutState = rollout(board, state)
+    """
+    bot_identity = board.current_player(current_state)  # 1 or 2
 
-        won = is_win(board, rolloutState, bot_identity)
-        backpropagate(node, won)
+    totals = search_tree(board, current_state, bot_identity, num_nodes)
 
     # Return an action, typically the most frequently used action (from the root) or the action with the best
     # estimated win rate.
-    best_action = get_best_action(root_node)
+    best_action = get_best_action(totals)
 
     print(f"Action chosen: {best_action}")
     return best_action
@@ -1,7 +1,26 @@
+from __future__ import annotations
+
+Action = tuple[int, int, int, int]      # (Board row, board column, square row, square column)
+State = tuple[int | None, ...]          # A packed game state, as made by p2_t3.Board
 
 
 class MCTSNode:
-    def __init__(self, parent=None, parent_action=None, action_list=[]):
+    # Thousands of these get made per move, so skip the per-instance __dict__
+    __slots__ = ('parent', 'parent_action', 'state', 'child_nodes', 'untried_actions', 'legal_actions',
+                 'wins', 'visits', 'virtual_loss')
+
+    parent: MCTSNode | None
+    parent_action: Action | None
+    state: State | None
+    child_nodes: list[tuple[Action, MCTSNode]]
+    untried_actions: list[Action]
+    legal_actions: list[Action] | None
+    wins: int
+    visits: int
+    virtual_loss: int
+
+    def __init__(self, parent: MCTSNode | None = None, parent_action: Action | None = None,
+                 action_list: list[Action] | None = None, state: State | None = None):
         """ Initializes the tree node for MCTS. The node stores links to other nodes in the tree (parent and child
         nodes), as well as keeps track of the number of wins and total simulations that have visited the node.
 
@@ -9,18 +28,22 @@ class MCTSNode:
             parent:         The parent node of this node.
             parent_action:  The action taken from the parent node that transitions the state to this node.
             action_list:    The list of legal actions to be considered at this node.
+            state:          The game state at this node, if known.
 
         """
         self.parent = parent                    # Parent node to this node
         self.parent_action = parent_action      # The move that got us to this node - "None" for the root node.
+        self.state = state                      # The game state at this node, so traversals don't replay moves.
 
-        self.child_nodes = {}                   # Action -> MCTSNode dictionary of children
-        self.untried_actions = action_list      # Yet unexplored actions
+        self.child_nodes = []                   # (Action, MCTSNode) pairs of children, in expansion order
+        self.untried_actions = action_list if action_list is not None else []  # Yet unexplored actions
+        self.legal_actions = None               # All legal actions at this node, saved when the node is expanded.
 
         self.wins = 0                           # Total wins of all paths through this node.
         self.visits = 0                         # Number of times this node has been visited.
+        self.virtual_loss = 0                   # Games through this node that are still being played out.
 
-    def __repr__(self):
+    def __repr__(self) -> str:
         """
         This method provides a string representing the node. Any time str(node) is used, this method is called.
         """
@@ -28,7 +51,7 @@ class MCTSNode:
                          "Win rate:", "{0:.0f}%".format(100 * self.wins / self.visits),
                          "Visits:", str(self.visits),  "]"])
 
-    def tree_to_string(self, horizon=1, indent=0):
+    def tree_to_string(self, horizon: int = 1, indent: int = 0) -> str:
         """ This method returns a string of the tree down to a defined horizon. The string is recursively constructed.
 
         Args:
@@ -40,6 +63,6 @@ class MCTSNode:
         """
         string = ''.join(['| ' for i in range(indent)]) + str(self) + '\n'
         if horizon > 0:
-            for child in self.child_nodes.values():
+            for action, child in self.child_nodes:
                 string += child.tree_to_string(horizon - 1, indent + 1)
         return string
@@ -1,13 +1,24 @@
-from mcts_node import MCTSNode
+from mcts_node import MCTSNode, Action, State
 from p2_t3 import Board
-from random import choice
+from random import random as random_float, seed, shuffle
 from math import sqrt, log
+from multiprocessing import get_all_start_methods, get_context
+import os
 
 num_nodes = 1000
 explore_faction = 2.
+# Independent trees searched side by side, see think(). Only counts the CPUs this process is allowed to run on
+num_workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+min_worker_iterations = 200  # Fewer than this and a worker's tree hardly gets past the root's moves (up to 81)
+num_rollouts = 4  # Random games played from every newly expanded node, so num_nodes * num_rollouts games in total
+batch_size = 8  # Leaves picked and expanded before any of their rollouts are played
+
+# Wikipedia says that the exploration factor is usually sqrt(2) and I dont see any instuctions in the lecture or the assignment so.....
+SQRT2 = 1.4142135623730951
 
 # Done
-def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
+def traverse_nodes(node: MCTSNode, board: Board, state: State,
+                   bot_identity: int) -> tuple[MCTSNode, State, list[MCTSNode]]:
     """ Traverses the tree until the end criterion are met.
     e.g. find the best expandable node (node with untried action) if it exists,
     or else a terminal node
@@ -21,32 +32,32 @@ def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
     Returns:
         node: A node from which the next stage of the search can proceed.
         state: The state associated with that node
+        path: The nodes walked through, from the given node down to the returned one
 
     """
+    path = [node]
+
     # Loop through the nodes
-    while node.untried_actions == [] and node.child_nodes != {}:
-        currentBestUcb = -9999  # That's gotta be low enough right? I can't possibly make a move *that* bad
-        bestChild = None
+    while not node.untried_actions and node.child_nodes:
+        # Both of these are the same for every child, so only work them out once per level
+        is_opponent = bot_identity != board.current_player(state)
+        log_parent_visits = log(node.visits + node.virtual_loss)
 
         # Check every child node and see which one is the best route to take
-        for action, child in node.child_nodes.items():
-            # Calculate the UCB value and replace it if it's better than the current best
-            ucbValue = ucb(child, bot_identity == board.current_player(state))
-
-            if ucbValue > currentBestUcb:
-                currentBestUcb = ucbValue
-                bestChild = child
+        _, bestChild = best_child(node.child_nodes, log_parent_visits, is_opponent)
 
         # Continue the search from that best child by replacing the node and state
-        if bestChild is not None:
-            node = bestChild
-            state = board.next_state(state, bestChild.parent_action)
+        node = bestChild
+        # expand_leaf always stores the state, so every node below the root has one
+        assert bestChild.state is not None
+        state = bestChild.state
+        path.append(node)
 
-    return node, state
+    return node, state, path
 
 
 #Done
-def expand_leaf(node: MCTSNode, board: Board, state):
+def expand_leaf(node: MCTSNode, board: Board, state: State) -> tuple[MCTSNode, State]:
     """ Adds a new leaf to the tree by creating a new child node for the given node (if it is non-terminal).
 
     Args:
@@ -55,13 +66,13 @@ def expand_leaf(node: MCTSNode, board: Board, state):
         state:  The state of the game.
 
     Returns:
-        node: The added child node
+        node: The added child node (or the given node, if it had nothing left to expand)
         state: The state associated with that node
 
     """
     # Let's first check to ensure that the node is not terminal (has untried actions)
     if not node.untried_actions:
-        return None, state
+        return node, state
 
     # Get the next untried action and try to expand upon it
     actionToExpand = node.untried_actions.pop()
@@ -69,150 +80,247 @@ def expand_leaf(node: MCTSNode, board: Board, state):
     # Get the new game state to be used for the new child node
     newGameState = board.next_state(state, actionToExpand)
 
-    # Create the new child node to be added to the given nodes's child nodes
-    newChildNode = MCTSNode(parent=node, parent_action=actionToExpand, action_list=board.legal_actions(newGameState))
-    node.child_nodes[actionToExpand] = newChildNode
+    # Create the new child node to be added to the given nodes's child nodes. The new state is saved on it (moves are
+    # deterministic, so later traversals can just reuse it) and so is the full list of legal actions (untried_actions
+    # gets popped from), so the rollouts from this node don't have to work it out again
+    legalActions = board.legal_actions(newGameState)
+    newChildNode = MCTSNode(parent=node, parent_action=actionToExpand, action_list=list(legalActions),
+                            state=newGameState)
+    newChildNode.legal_actions = legalActions
+    node.child_nodes.append((actionToExpand, newChildNode))
 
     return newChildNode, newGameState
 
 
 # Done
-def rollout(board: Board, state):
+def rollout(board: Board, state: State, legal_actions: list[Action] | None = None) -> State:
     """ Given the state of the game, the rollout plays out the remainder randomly.
 
     Args:
         board:  The game setup.
         state:  The state of the game.
+        legal_actions:  The legal actions in the given state, if they're already known.
     
     Returns:
         state: The terminal game state
 
     """
+    # This loop runs for every move of every simulated game, so look the methods up once instead of every time
+    is_ended = board.is_ended
+    get_legal_actions = board.legal_actions
+    next_state = board.next_state
+    _random = random_float
+
+    while not is_ended(state):
+        if legal_actions is None:
+            legal_actions = get_legal_actions(state)
 
-    while not board.is_ended(state):
         # Choose a random legal action, do it, and repeat until the game is over
-        chosenAction = choice(board.legal_actions(state))
-        state = board.next_state(state, chosenAction)
+        # (picking the index straight from random() is quite a bit cheaper than going through choice())
+        chosenAction = legal_actions[int(_random() * len(legal_actions))]
+        state = next_state(state, chosenAction)
+        legal_actions = None
 
     return state
 
 # Done
-def backpropagate(node: MCTSNode | None, won: bool):
-    """ Navigates the tree from a leaf node to the root, updating the win and visit count of each node along the path.
+def backpropagate(path: list[MCTSNode], wins: int, visits: int) -> None:
+    """ Updates the win and visit count of each node along the path from the root to a leaf.
 
     Args:
-        node:   A leaf node.
-        won:    An indicator of whether the bot won or lost the game.
+        path:   The nodes from the root down to the leaf, as collected by traverse_nodes and expand_leaf.
+        wins:   How many of the simulated games the bot won.
+        visits: How many games were simulated. These were marked as virtual loss when the leaf was picked, so that
+                gets taken back in the same pass.
 
     """
-    # The signature says that node can be None and the parent of a root node is probably none, so that should just be our exit condition
-    while node is not None:
-        # Update the visit count
-        node.visits += 1
+    # We already have the path from the traversal, so no need to chase parent pointers back up
+    for node in path:
+        # Update the visit and win counts, and settle the virtual loss for these games
+        node.visits += visits
+        node.wins += wins
+        node.virtual_loss -= visits
 
-        # If the bot won, update the win count
-        if won:
-            node.wins += 1
 
-        # Move to the parent node
-        node = node.parent
+def add_virtual_loss(path: list[MCTSNode], amount: int) -> None:
+    """ Adds virtual loss on every node along the path from the root to a leaf. backpropagate() takes it back off again.
 
-        # Also, the slides said to do this recursively, but that doesn't really seem necessary when the loop is so simple (unless im really off here and in that case, whoops!)
+    Args:
+        path:   The nodes from the root down to the leaf.
+        amount: The number of games being played out from the leaf.
+
+    """
+    for node in path:
+        node.virtual_loss += amount
 
 
-# Done
-def ucb(node: MCTSNode, is_opponent: bool):
-    """ Calculates the UCB value for the given node from the perspective of the bot
+def best_child(children: list[tuple[Action, MCTSNode]], log_parent_visits: float,
+               is_opponent: bool) -> tuple[Action, MCTSNode]:
+    """ Picks the child with the highest UCB value. This is the selection kernel that traverse_nodes runs at every
+    level, so the whole UCB calculation is done in one flat loop instead of a function call per child.
 
     Args:
-        node:   A node.
+        children:   The (action, child) pairs of a fully expanded node. Must not be empty.
+        log_parent_visits: The natural log of the parent node's visit count
         is_opponent: A boolean indicating whether or not the last action was performed by the MCTS bot
     Returns:
-        The value of the UCB function for the given node
+        The (action, child) pair with the best UCB value
     """
+    bestItem = children[0]
+    bestUcb = -1.0  # UCB values are never negative, so anything beats this
 
     # Equation was given in the lecture: (node wins) / (node visits) + (exploration factor) * sqrt(ln(parent node visits) / (node visits))
+    # with any games still being played through a node counted as extra visits that the picking player lost
 
-    explorationFactor = sqrt(2) # Wikipedia says that the exploration factor is usually sqrt(2) and I dont see any instuctions in the lecture or the assignment so.....
+    # Local names are a lot cheaper to look up than globals inside the loop
+    _sqrt = sqrt
+    explorationFactor = SQRT2
 
-    winRate = node.wins / node.visits
+    for item in children:
+        child = item[1]
+        # Games still being played through the child count as losses for whoever is picking, so that the other
+        # leaves in a batch get spread over different paths
+        visits = child.visits + child.virtual_loss
+        if is_opponent:
+            winRate = 1 - (child.wins + child.virtual_loss) / visits
+        else:
+            winRate = child.wins / visits
+        ucbValue = winRate + explorationFactor * _sqrt(log_parent_visits / visits)
 
-    # Adjust winRate if the last action was performed by the opponent
-    if is_opponent:
-        winRate = 1 - winRate
+        if ucbValue > bestUcb:
+            bestUcb = ucbValue
+            bestItem = item
 
-    return winRate + (explorationFactor * sqrt(log(node.parent.visits) / node.visits))
+    return bestItem
 
 
 # Done
-def get_best_action(root_node: MCTSNode):
+def get_best_action(totals: dict[Action, tuple[int, int]]) -> Action | None:
     """ Selects the best action from the root node in the MCTS tree
 
     Args:
-        root_node:   The root node
+        totals:   The (wins, visits) of every root action, merged across all the search trees
     Returns:
         action: The best action from the root node
     
     """
 
-    # Let's just loop through the child nodes and see which one has the highest win rate
-    bestAction = None
-    bestWinRate = -9999
+    # Nothing was expanded (no legal moves), so there's nothing to pick
+    if not totals:
+        return None
 
-    for action, child in root_node.child_nodes.items():
-        winRate = child.wins / child.visits
-        if winRate > bestWinRate:
-            bestWinRate = winRate
-            bestAction = action
+    # Let's just see which one of the root actions has the highest win rate
+    return max(totals, key=lambda action: totals[action][0] / totals[action][1])
 
-    return bestAction
 
-
-def is_win(board: Board, state, identity_of_bot: int):
+def is_win(board: Board, state: State, identity_of_bot: int) -> bool:
     # checks if state is a win state for identity_of_bot
     outcome = board.points_values(state)
     assert outcome is not None, "is_win was called on a non-terminal state"
     return outcome[identity_of_bot] == 1
 
 
-def think(board: Board, current_state):
-    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+def search_tree(board: Board, current_state: State, bot_identity: int, iterations: int,
+                shuffle_root: bool = False) -> dict[Action, tuple[int, int]]:
+    """ Builds a fresh MCTS tree from the current state and reports what it found about each move from the root.
+    think() runs one of these per worker process.
 
     Args:
         board:  The game setup.
         current_state:  The current state of the game.
+        bot_identity:   The bot's identity, either 1 or 2
+        iterations: The number of MCTS iterations to run on this tree.
+        shuffle_root:   Whether to expand the root's moves in a random order, so parallel trees don't all start out
+                        the same way.
 
-    Returns:    The action to be taken from the current state
+    Returns:    An action -> (wins, visits) dictionary for the children of the root node
 
     """
-    bot_identity = board.current_player(current_state)  # 1 or 2
-    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state),
+                         state=current_state)
+
+    if shuffle_root:
+        shuffle(root_node.untried_actions)
+
+    # The iterations are done in batches: pick and expand a handful of leaves first, then play all of their rollouts
+    for batchStart in range(0, iterations, batch_size):
+        leaves: list[tuple[MCTSNode, State, list[MCTSNode]]] = []
+
+        for _ in range(min(batch_size, iterations - batchStart)):
+            # Do MCTS - This is all you!
+            # AAAA - I don't want it to be all me. It's scary
 
-    for _ in range(num_nodes):
-        state = current_state
-        node = root_node
+            #Step 1: Traverse the tree (traverse_nodes already keeps going until it hits an expandable or terminal node)
+            node, state, path = traverse_nodes(root_node, board, current_state, bot_identity)
 
-        # Do MCTS - This is all you!
-        # AAAA - I don't want it to be all me. It's scary
+            #Step 2: expand the leaf if we can
+            if node.untried_actions:
+                node, state = expand_leaf(node, board, state)
+                path.append(node)
 
-        #Step 1: Traverse the tree
-        while not node.untried_actions and node.child_nodes:
-            node, state = traverse_nodes(node, board, state, bot_identity)
+            # Mark the games we're about to play as virtual losses until they finish. New nodes never have 0 visits
+            # in the UCB math that way, and the rest of the batch gets pushed towards other paths
+            add_virtual_loss(path, num_rollouts)
+            leaves.append((node, state, path))
 
-        #Step 2: expand the leaf if we can
-        if node.untried_actions:
-            node, state = expand_leaf(node, board, state)
+        for node, state, path in leaves:
+            #Step 3: Rollout to see how this might play out. Doing a few of them gives the new node a less noisy
+            # starting estimate for the same amount of tree work
+            wins = 0
+            for _ in range(num_rollouts):
+                rolloutState = rollout(board, state, node.legal_actions)
+                if is_win(board, rolloutState, bot_identity):
+                    wins += 1
 
-        #Step 3: Rollout to see how this might play out
-        rolloutState = rollout(board, state)
+            #Step 4: Backpropagate, swapping the virtual losses for the real results
+            backpropagate(path, wins, num_rollouts)
+
+    return {action: (child.wins, child.visits) for action, child in root_node.child_nodes}
+
+
+def think(board: Board, current_state: State) -> Action | None:
+    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+
+    num_nodes is the number of tree iterations per move, and each one plays num_rollouts games from its leaf. That's
+    num_rollouts times the rollout work of a single game per leaf, which the worker processes share out.
+
+    The search is root parallel: each worker process grows its own tree with an equal share of the iterations, and the
+    visit and win counts of the root's children are added together at the end. Only as many workers are used as
+    can each get at least min_worker_iterations.
+
+    Args:
+        board:  The game setup.
+        current_state:  The current state of the game.
+
+    Returns:    The action to be taken from the current state
+
+    """
+    bot_identity = board.current_player(current_state)  # 1 or 2
 
-        #Step 4: Backpropagate
-        won = is_win(board, rolloutState, bot_identity)
-        backpropagate(node, won)
+    # Only fork is safe here: the game scripts don't have a __main__ guard, so spawned workers would re-run them
+    workers = num_workers if "fork" in get_all_start_methods() else 1
+    workers = max(1, min(workers, num_nodes // min_worker_iterations))
+    jobs = [(board, current_state, bot_identity, num_nodes // workers + (i < num_nodes % workers), workers > 1)
+            for i in range(workers)]
+
+    if workers > 1:
+        # seed() with no arguments reseeds each worker from the OS, so their rollouts differ without touching the
+        # random state of the game process itself
+        with get_context("fork").Pool(workers, initializer=seed) as pool:
+            results = pool.starmap(search_tree, jobs)
+    else:
+        results = [search_tree(*job) for job in jobs]
+
+    # Merge all the trees' root children so we can pick from their combined results
+    totals: dict[Action, tuple[int, int]] = {}
+    for result in results:
+        for action, (wins, visits) in result.items():
+            totalWins, totalVisits = totals.get(action, (0, 0))
+            totals[action] = (totalWins + wins, totalVisits + visits)
 
     # Return an action, typically the most frequently used action (from the root) or the action with the best
     # estimated win rate.
-    best_action = get_best_action(root_node)
+    best_action = get_best_action(totals)
 
     print(f"Action chosen: {best_action}")
     return best_action